@@ -3,22 +3,25 @@ ADAF - inference
 Created on 26 May 2023
 @author: Nejc Čož, ZRC SAZU, Novi trg 2, 1000 Ljubljana, Slovenia
 """
-import glob
+import io
 import logging
 import os
+import queue
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import chain
 from pathlib import Path
 from time import localtime, strftime
 
 import geopandas as gpd
 import numpy as np
-import pandas as pd
 import rasterio
+import shapely
 from aitlas.models import FasterRCNN, HRNet
 from pyproj import CRS
 from rasterio.features import shapes
-from shapely.geometry import box, shape
+from rasterio.windows import Window
 from torch import cuda
 
 import adaf.grid_tools as gt
@@ -34,6 +37,187 @@ from adaf.adaf_vis import tiled_processing
 
 logging.disable(logging.INFO)
 
+# Probe the CUDA driver only once
+CUDA_AVAILABLE = cuda.is_available()
+
+# Use pyogrio for writing vector files (batched writes through GDAL), fall back to Fiona if it is not installed
+try:
+    import pyogrio  # noqa: F401
+    VECTOR_ENGINE = "pyogrio"
+except ImportError:
+    VECTOR_ENGINE = "fiona"
+
+# Numba is optional, it is used to compile coordinate transformation of bounding boxes
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+# Transforms pixel coordinates of bounding boxes to map coordinates, returns (4, n) array with rows x0, y0, x1, y1.
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def bbox_pixels_to_map(x0, y0, x1, y1, res, x_min, y_max):
+        out = np.empty((4, x0.shape[0]))
+        # Single pass over all arrays, no temporary arrays
+        for i in prange(x0.shape[0]):
+            out[0, i] = x_min[i] + res[i] * x0[i]
+            out[1, i] = y_max[i] - res[i] * y0[i]
+            out[2, i] = x_min[i] + res[i] * x1[i]
+            out[3, i] = y_max[i] - res[i] * y1[i]
+        return out
+else:
+    def bbox_pixels_to_map(x0, y0, x1, y1, res, x_min, y_max):
+        return np.stack((x_min + res * x0, y_max - res * y0, x_min + res * x1, y_max - res * y1))
+
+
+def read_bbox_predictions(predicts_dir):
+    """Reads all object detection TXT files from directory into a single array.
+
+    Non-empty files are concatenated and parsed in one call, the label column is skipped (label is known from the
+    directory). Rows of the output array are ordered by file, ``row_counts`` gives the number of rows per file.
+    EPSG code is the same for all bounding boxes, so it is only read from the first line and its column is skipped.
+
+    Parameters
+    ----------
+    predicts_dir : str or pathlib.Path()
+        Path to directory with results (TXT files) for one label.
+
+    Returns
+    -------
+    (np.ndarray, list, np.ndarray, int)
+        Array with columns x0, y0, x1, y1, score, res, x_min, y_max, list of paths to files, number of rows
+        (bounding boxes) in each file and EPSG code (None if there are no bounding boxes).
+    """
+    # Only read files that are not empty
+    with os.scandir(predicts_dir) as entries:
+        file_paths = [a.path for a in entries if a.name.endswith(".txt") and a.stat().st_size > 0]
+
+    # Reading is I/O bound (releases the GIL), read files concurrently
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        contents = list(executor.map(lambda pth: Path(pth).read_bytes(), file_paths))
+
+    # Every row (bbox) has to end with new line, so rows can be counted
+    contents = [a if a.endswith(b"\n") else a + b"\n" for a in contents]
+
+    row_counts = np.array([a.count(b"\n") for a in contents], dtype=np.int64)
+    if not contents:
+        return np.empty((0, 8)), file_paths, row_counts, None
+
+    epsg = int(contents[0].split(maxsplit=7)[6])
+    data = np.loadtxt(
+        io.BytesIO(b"".join(contents)),
+        delimiter=" ",
+        usecols=(0, 1, 2, 3, 5, 7, 8, 9),
+        ndmin=2
+    )
+
+    return data, file_paths, row_counts, epsg
+
+
+def cascaded_union(geoms, chunk=100):
+    """Union of geometries computed in chunks, partial results are then joined into the final geometry. Chunks are
+    joined one after another, this runs inside the pool of segmentation tiles and GEOS cascades each union internally.
+
+    Parameters
+    ----------
+    geoms : np.ndarray
+        Array of Shapely geometries.
+    chunk : int
+        Number of geometries joined in one chunk.
+
+    Returns
+    -------
+    shapely.Geometry
+        Union of all geometries.
+    """
+    if len(geoms) <= chunk:
+        return shapely.union_all(geoms)
+
+    partial_unions = [shapely.union_all(geoms[i:i + chunk]) for i in range(0, len(geoms), chunk)]
+
+    return shapely.union_all(partial_unions)
+
+
+def overlapping_groups(geoms):
+    """Finds groups of overlapping geometries. Pairs of intersecting geometries are found with STRtree, groups are
+    connected components of these pairs (union-find).
+
+    Parameters
+    ----------
+    geoms : np.ndarray
+        Array of Shapely geometries.
+
+    Returns
+    -------
+    np.ndarray
+        Group index of each geometry, disjoint geometries are alone in their group.
+    """
+    left, right = shapely.STRtree(geoms).query(geoms, predicate="intersects")
+
+    # Each geometry intersects itself, only pairs of different geometries are needed (each pair once)
+    pairs = left < right
+    parent = list(range(len(geoms)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in zip(left[pairs].tolist(), right[pairs].tolist()):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    return np.array([find(i) for i in range(len(geoms))])
+
+
+def dissolve_overlapping(geoms, scores=None):
+    """Joins overlapping polygons, disjoint polygons are kept separate. Each joined polygon keeps the max score of the
+    polygons it intersects.
+
+    Only groups of intersecting polygons (see overlapping_groups()) are passed to union, single and disjoint polygons
+    are returned as they are.
+
+    Parameters
+    ----------
+    geoms : np.ndarray
+        Array of Shapely polygons.
+    scores : np.ndarray
+        Optional - score of each polygon.
+
+    Returns
+    -------
+    (np.ndarray, np.ndarray)
+        Joined polygons and their scores (None if scores are not given).
+    """
+    # Single polygon, nothing to join
+    if len(geoms) == 1:
+        return geoms, scores
+
+    _, group_idx, group_counts = np.unique(overlapping_groups(geoms), return_inverse=True, return_counts=True)
+    single = group_counts[group_idx] == 1
+
+    if single.all():
+        return geoms, scores
+
+    # Union only polygons inside each group of overlapping polygons
+    to_join = geoms[~single]
+    joined = [cascaded_union(geoms[group_idx == group]) for group in np.flatnonzero(group_counts > 1)]
+    # Split unions into separate polygons (e.g. polygons touching only in one point)
+    joined = shapely.get_parts(joined)
+
+    if scores is not None:
+        # Select max score of polygons that form the joined polygon (groups are disjoint, so a joined polygon only
+        # intersects polygons of its own group)
+        joined_idx, to_join_idx = shapely.STRtree(to_join).query(joined, predicate="intersects")
+        joined_scores = np.full(len(joined), -np.inf)
+        np.maximum.at(joined_scores, joined_idx, scores[~single][to_join_idx])
+        scores = np.concatenate([scores[single], joined_scores])
+
+    return np.concatenate([geoms[single], joined]), scores
+
 
 def object_detection_vectors(predictions_dirs_dict, threshold=0.5, keep_ml_paths=False, min_area=None):
     """Converts object detection bounding boxes from text to vector format.
@@ -59,60 +243,62 @@ def object_detection_vectors(predictions_dirs_dict, threshold=0.5, keep_ml_paths
     # Prepare output path (GPKG file in the data folder)
     output_path = path_to_predictions.parent / "object_detection.gpkg"
 
+    # Read predictions from all TXT files at once (for each label)
+    predictions = {a: read_bbox_predictions(b) for a, b in predictions_dirs_dict.items()}
+
+    # EPSG code is added to every bbox, doesn't matter which we chose, it has to be the same for all entries
+    epsg = next((a[3] for a in predictions.values() if a[3] is not None), None)
+    crs = CRS.from_epsg(epsg) if epsg is not None else None
+
     appended_data = []
-    crs = None
-    for label, predicts_dir in predictions_dirs_dict.items():
-        predicts_dir = Path(predicts_dir)
-        file_list = list(predicts_dir.glob(f"*.txt"))
-
-        for file_path in file_list:
-            # Only read files that are not empty
-            if not os.stat(file_path).st_size == 0:
-                # Read predictions from TXT file
-                data = pd.read_csv(file_path, sep=" ", header=None)
-                data.columns = ["x0", "y0", "x1", "y1", "label", "score", "epsg", "res", "x_min", "y_max"]
-
-                # EPSG code is added to every bbox, doesn't matter which we chose, it has to be the same for all entries
-                if crs is None:
-                    crs = CRS.from_epsg(int(data.epsg[0]))
-
-                data.x0 = data.x_min + (data.res * data.x0)
-                data.x1 = data.x_min + (data.res * data.x1)
-                data.y0 = data.y_max - (data.res * data.y0)
-                data.y1 = data.y_max - (data.res * data.y1)
-
-                data["geometry"] = [box(*a) for a in zip(data.x0, data.y0, data.x1, data.y1)]
-                data.drop(columns=["x0", "y0", "x1", "y1", "epsg", "res", "x_min", "y_max"], inplace=True)
-
-                # Filter by probability threshold
-                data = data[data['score'] > threshold]
-
-                # Convert pandas to geopandas
-                data = gpd.GeoDataFrame(data, crs=crs)
-
-                # Add paths to ML results
-                agg_func = {'score': 'max', 'label': 'first'}
-                if keep_ml_paths:
-                    data["prediction_path"] = str(Path().joinpath(*file_path.parts[-3:]))
-                    agg_func['prediction_path'] = 'first'
-
-                # Don't append if there are no predictions left after filtering
-                if data.shape[0] > 0:
-                    # Join overlapping polygons (dissolve and keep disjoint separate)
-                    data_ = gpd.GeoDataFrame(
-                        geometry=[data.unary_union],
-                        crs=data.crs
-                    ).explode(index_parts=False).reset_index(drop=True)
-                    # Keep attributes from original gdf, select max score
-                    data_ = gpd.sjoin(data_, data, how='left').drop(columns=['index_right'])
-
-                    data_ = data_.dissolve(data_.index, aggfunc=agg_func)
-
-                    appended_data.append(data_)
+    for label, (data, file_paths, row_counts, _) in predictions.items():
+        if data.shape[0] == 0:
+            continue
+
+        x0, y0, x1, y1, score, res, x_min, y_max = np.ascontiguousarray(data.T)
+
+        # Transform pixel coordinates to map coordinates
+        x0, y0, x1, y1 = bbox_pixels_to_map(x0, y0, x1, y1, res, x_min, y_max)
+
+        # Construct all bounding boxes in one vectorized call
+        geoms = shapely.box(x0, y0, x1, y1)
+        file_idx = np.repeat(np.arange(len(file_paths)), row_counts)
+
+        # Filter by probability threshold
+        keep = score > threshold
+        geoms = geoms[keep]
+        score = score[keep]
+        file_idx = file_idx[keep]
+
+        # Rows are ordered by file, find where bboxes of each file start and end
+        file_bounds = np.searchsorted(file_idx, np.arange(len(file_paths) + 1))
+
+        for i, file_path in enumerate(file_paths):
+            start, end = file_bounds[i], file_bounds[i + 1]
+            # Don't append if there are no predictions left after filtering
+            if start == end:
+                continue
+
+            # Join overlapping polygons (dissolve and keep disjoint separate)
+            file_geoms, file_scores = dissolve_overlapping(geoms[start:end], score[start:end])
+
+            # Add paths to ML results
+            ml_path = str(Path().joinpath(*Path(file_path).parts[-3:]))
+
+            appended_data.append((
+                file_geoms,
+                np.full(len(file_geoms), label, dtype=object),
+                file_scores,
+                np.full(len(file_geoms), ml_path, dtype=object)
+            ))
 
     if appended_data:
-        # We have at least one detection
-        gdf = gpd.GeoDataFrame(pd.concat(appended_data, ignore_index=True), crs=crs)
+        # We have at least one detection, build a single GeoDataFrame from all arrays
+        geoms, labels, scores, ml_paths = (np.concatenate(a) for a in zip(*appended_data))
+        attributes = {"label": labels, "score": scores}
+        if keep_ml_paths:
+            attributes["prediction_path"] = ml_paths
+        gdf = gpd.GeoDataFrame(attributes, geometry=geoms, crs=crs)
 
         # Post-processing
         if min_area:
@@ -120,13 +306,87 @@ def object_detection_vectors(predictions_dirs_dict, threshold=0.5, keep_ml_paths
             gdf = gdf[gdf["area"] > min_area]
 
         # Export file
-        gdf.to_file(str(output_path), driver="GPKG")
+        gdf.to_file(str(output_path), driver="GPKG", engine=VECTOR_ENGINE)
     else:
         output_path = ""
 
     return str(output_path)
 
 
+def polygons_from_shapes(polygons):
+    """Constructs Shapely polygons from GeoJSON-like polygons (output of rasterio.features.shapes) in a single
+    vectorized call, without creating Shapely objects one by one.
+
+    Parameters
+    ----------
+    polygons : list
+        A list of GeoJSON-like dicts with "coordinates" of polygon rings (first ring is exterior, others are holes).
+
+    Returns
+    -------
+    np.ndarray
+        Array of Shapely polygons.
+    """
+    rings = [ring for polygon in polygons for ring in polygon["coordinates"]]
+    # Polygon to which each ring belongs and ring to which each vertex belongs
+    ring_idx = np.repeat(np.arange(len(polygons)), [len(a["coordinates"]) for a in polygons])
+    vertex_idx = np.repeat(np.arange(len(rings)), [len(a) for a in rings])
+
+    # Vertices of all rings are converted to a single array at once (not ring by ring)
+    coords = np.array(list(chain.from_iterable(rings)), dtype=float)
+    rings = shapely.linearrings(coords, indices=vertex_idx)
+
+    return shapely.polygons(rings, indices=ring_idx)
+
+
+def polygonize_probability_mask(file, threshold=0.5):
+    """Converts a single semantic segmentation probability mask (one tile) to polygons using a threshold.
+
+    Parameters
+    ----------
+    file : str or pathlib.Path()
+        Path to probability mask (GeoTIFF).
+    threshold : float
+        Probability threshold for predictions.
+
+    Returns
+    -------
+    (np.ndarray, rasterio.crs.CRS)
+        Array of polygons of predicted features (empty if there are no features in the tile) and CRS of the tile.
+    """
+    with rasterio.open(file) as src:
+        prob_mask = src.read(1)
+        transform = src.transform
+        crs = src.crs
+
+    # Skip the tile if there are no features, a single reduction before any masks are allocated
+    max_prob = np.nanmax(prob_mask)
+    if np.isnan(max_prob) or max_prob < float(threshold):
+        return np.empty(0, dtype=object), crs
+
+    # Mask probability map by threshold for extraction of polygons
+    feature = prob_mask >= float(threshold)
+
+    # Find rows and columns with features
+    rows = np.flatnonzero(feature.any(axis=1))
+    cols = np.flatnonzero(feature.any(axis=0))
+
+    # Only trace polygons inside the window (bounding box) of features
+    window = Window.from_slices((rows[0], rows[-1] + 1), (cols[0], cols[-1] + 1))
+    feature = feature[window.toslices()]
+    transform = rasterio.windows.transform(window, transform)
+
+    # Outputs (polygon, value) tuples, masking ensures only features (value = 1) are traced
+    output = shapes(feature.astype(np.uint8), mask=feature, transform=transform)
+
+    poly = [polygon for polygon, _ in output]
+
+    # Dissolve and keep disjoint separate
+    geoms, _ = dissolve_overlapping(polygons_from_shapes(poly))
+
+    return geoms, crs
+
+
 def semantic_segmentation_vectors(predictions_dirs_dict, threshold=0.5,
                                   keep_ml_paths=False, roundness=None, min_area=None):
     """Converts semantic segmentation probability masks to polygons using a threshold. If more than one class, all
@@ -156,49 +416,35 @@ def semantic_segmentation_vectors(predictions_dirs_dict, threshold=0.5,
     # Output path (GPKG file in the data folder)
     output_path = path_to_predictions.parent / "semantic_segmentation.gpkg"
 
+    # Tiles are independent, reading (GDAL) and tracing polygons release the GIL, so process them in threads
     gdf_out = []
-    for label, predicts_dir in predictions_dirs_dict.items():
-        predicts_dir = Path(predicts_dir)
-        tif_list = list(predicts_dir.glob(f"*.tif"))
-
-        # file = tif_list[4]
-
-        for file in tif_list:
-            with rasterio.open(file) as src:
-                prob_mask = src.read()
-                transform = src.transform
-                crs = src.crs
-
-                prediction = prob_mask.copy()
-
-                # Mask probability map by threshold for extraction of polygons
-                feature = prob_mask >= float(threshold)
-                background = prob_mask < float(threshold)
-
-                prediction[feature] = 1
-                prediction[background] = 0
-
-                # Outputs a list of (polygon, value) tuples
-                output = list(shapes(prediction, transform=transform))
-
-                # Find polygon covering valid data (value = 1) and transform to GDF friendly format
-                poly = []
-                for polygon, value in output:
-                    if value == 1:
-                        poly.append(shape(polygon))
-
-            # If there is at least one polygon, convert to GeoDataFrame and append to list for output
-            if poly:
-                predicted_labels = gpd.GeoDataFrame(poly, columns=['geometry'], crs=crs)
-                predicted_labels = predicted_labels.dissolve().explode(ignore_index=True)
-                predicted_labels["label"] = label
-                if keep_ml_paths:
-                    predicted_labels["prediction_path"] = str(Path().joinpath(*file.parts[-3:]))
-                gdf_out.append(predicted_labels)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = []
+        for label, predicts_dir in predictions_dirs_dict.items():
+            with os.scandir(predicts_dir) as entries:
+                tif_list = [a.path for a in entries if a.name.endswith(".tif")]
+            futures += [
+                (label, file, executor.submit(polygonize_probability_mask, file, threshold))
+                for file in tif_list
+            ]
+
+        for label, file, future in futures:
+            geoms, crs = future.result()
+            # If there is at least one polygon in the tile, append arrays to list for output
+            if len(geoms) > 0:
+                gdf_out.append((
+                    geoms,
+                    np.full(len(geoms), label, dtype=object),
+                    np.full(len(geoms), str(Path().joinpath(*Path(file).parts[-3:])), dtype=object)
+                ))
 
     if gdf_out:
-        # We have at least one detection
-        gdf = gpd.GeoDataFrame(pd.concat(gdf_out, ignore_index=True), crs=crs)
+        # We have at least one detection, build a single GeoDataFrame from all arrays
+        geoms, labels, ml_paths = (np.concatenate(a) for a in zip(*gdf_out))
+        attributes = {"label": labels}
+        if keep_ml_paths:
+            attributes["prediction_path"] = ml_paths
+        gdf = gpd.GeoDataFrame(attributes, geometry=geoms, crs=crs)
 
         # # If same object from two different tiles overlap, join them into one
         # In semantic segmentation this will never happen, because each pixel can belong to only one polygon (when
@@ -213,14 +459,14 @@ def semantic_segmentation_vectors(predictions_dirs_dict, threshold=0.5,
             gdf = gdf[gdf["area"] > min_area]
 
         # Export file
-        gdf.to_file(output_path.as_posix(), driver="GPKG")
+        gdf.to_file(output_path.as_posix(), driver="GPKG", engine=VECTOR_ENGINE)
     else:
         output_path = ""
 
     return str(output_path)
 
 
-def run_visualisations(dem_path, tile_size, save_dir, nr_processes=1):
+def run_visualisations(dem_path, tile_size, save_dir, nr_processes=1, tile_callback=None):
     """Calculates visualisations from DEM and saves them into VRT (Geotiff) file.
 
     Uses RVT (see adaf_vis.py).
@@ -235,6 +481,8 @@ def run_visualisations(dem_path, tile_size, save_dir, nr_processes=1):
         Save directory.
     nr_processes : int
         Number of processes for parallel computing.
+    tile_callback : callable
+        Optional - called with the path of each tile as soon as its visualization is saved.
 
     Returns
     -------
@@ -247,7 +495,7 @@ def run_visualisations(dem_path, tile_size, save_dir, nr_processes=1):
     # We need polygon covering valid data
     valid_data_outline, _ = gt.poly_from_valid(in_file.as_posix())
 
-    # Create reference grid, filter it and save it to disk
+    # Create reference grid and filter it (kept in memory, nothing is written to disk)
     tiles_extents = gt.bounding_grid(in_file.as_posix(), tile_size, tag=False)
     tiles_extents = gt.filter_by_outline(tiles_extents, valid_data_outline)
 
@@ -257,7 +505,8 @@ def run_visualisations(dem_path, tile_size, save_dir, nr_processes=1):
         input_raster_path=in_file.as_posix(),
         extents_list=tiles_extents,
         nr_processes=nr_processes,
-        save_dir=Path(save_dir)
+        save_dir=Path(save_dir),
+        tile_callback=tile_callback
     )
 
     return out_paths
@@ -304,7 +553,7 @@ def run_tiling(dem_path, tile_size, save_dir, nr_processes=1):
     return out_paths
 
 
-def run_aitlas_object_detection(labels, images_dir, custom_model=None):
+def run_aitlas_object_detection(labels, images_dir, custom_model=None, batch_size=8, tiles=None):
     """Runs AiTLAS for object detection. There are 4 trained models (binary classification) for four different classes
     (e.g. labels). The models are stored relatively to the script path in the "ml_models" folder.
 
@@ -316,6 +565,11 @@ def run_aitlas_object_detection(labels, images_dir, custom_model=None):
         Path to directory containing tiles for inference.
     custom_model : str or pathlib.Path()
         Path to tar file for custom model.
+    batch_size : int
+        Number of tiles passed through the model at once.
+    tiles : iterable
+        Optional - iterable of paths to tiles (e.g. tiles that are still being created), used for the first label
+        instead of listing images_dir. Other labels are run on all tiles in images_dir.
 
     Returns
     -------
@@ -333,44 +587,51 @@ def run_aitlas_object_detection(labels, images_dir, custom_model=None):
         "custom": custom_model
     }
 
-    if cuda.is_available():
+    if CUDA_AVAILABLE:
         logging.debug("> CUDA is available, running predictions on GPU!")
     else:
         logging.debug("> No CUDA detected, running predictions on CPU!")
 
+    # Prepare the model (same for all labels, only weights are loaded for each label)
+    model_config = {
+        "num_classes": 2,  # Number of classes in the dataset
+        "learning_rate": 0.0001,  # Learning rate for training
+        "pretrained": True,  # Whether to use a pretrained model or not
+        "use_cuda": CUDA_AVAILABLE,  # Set to True if you want to use GPU acceleration
+        "metrics": ["map"]  # Evaluation metrics to be used
+    }
+    model = FasterRCNN(model_config)
+    model.prepare()
+    # load_model is not strict, weights missing in a checkpoint would be kept from the previously loaded label
+    initial_state = {k: v.clone() for k, v in model.model.state_dict().items()}
+
     predictions_dirs = {}
     for label in labels:
-        # Prepare the model
-        model_config = {
-            "num_classes": 2,  # Number of classes in the dataset
-            "learning_rate": 0.0001,  # Learning rate for training
-            "pretrained": True,  # Whether to use a pretrained model or not
-            "use_cuda": cuda.is_available(),  # Set to True if you want to use GPU acceleration
-            "metrics": ["map"]  # Evaluation metrics to be used
-        }
-        model = FasterRCNN(model_config)
-        model.prepare()
-
         # Prepare path to the model
         model_path = models.get(label)
         # Path is relative to the Current script directory
         model_path = Path(__file__).resolve().parent / model_path
-        # Load appropriate ADAF model
+        # Load appropriate ADAF model (starting from the initial weights)
+        model.model.load_state_dict(initial_state)
         model.load_model(model_path)
         logging.debug("Model successfully loaded.")
 
         preds_dir = make_predictions_on_patches_object_detection(
             model=model,
             label=label,
-            patches_folder=images_dir
+            patches_folder=images_dir,
+            batch_size=batch_size,
+            tiles=tiles
         )
 
         predictions_dirs[label] = preds_dir
+        # Stream of tiles is consumed, all tiles are in images_dir for the remaining labels
+        tiles = None
 
     return predictions_dirs
 
 
-def run_aitlas_segmentation(labels, images_dir, custom_model=None):
+def run_aitlas_segmentation(labels, images_dir, custom_model=None, batch_size=8, tiles=None):
     """Runs AiTLAS for segmentation. There are 4 trained models (binary classification) for four different classes
     (e.g. labels). The models are stored relatively to the script path in the "ml_models" folder.
 
@@ -382,6 +643,11 @@ def run_aitlas_segmentation(labels, images_dir, custom_model=None):
         Path to directory containing tiles for inference.
     custom_model : str or pathlib.Path()
         Path to tar file for custom model.
+    batch_size : int
+        Number of tiles passed through the model at once.
+    tiles : iterable
+        Optional - iterable of paths to tiles (e.g. tiles that are still being created), used for the first label
+        instead of listing images_dir. Other labels are run on all tiles in images_dir.
 
     Returns
     -------
@@ -399,25 +665,27 @@ def run_aitlas_segmentation(labels, images_dir, custom_model=None):
         "custom": custom_model
     }
 
-    if cuda.is_available():
+    if CUDA_AVAILABLE:
         logging.debug("> CUDA is available, running predictions on GPU!")
     else:
         logging.debug("> No CUDA detected, running predictions on CPU!")
 
+    # Prepare the model (same for all labels, only weights are loaded for each label)
+    model_config = {
+        "num_classes": 2,  # Number of classes in the dataset
+        "learning_rate": 0.0001,  # Learning rate for training
+        "pretrained": True,  # Whether to use a pretrained model or not
+        "use_cuda": CUDA_AVAILABLE,  # Set to True if you want to use GPU acceleration
+        "threshold": 0.5,
+        "metrics": ["iou"]  # Evaluation metrics to be used
+    }
+    model = HRNet(model_config)
+    model.prepare()
+    # load_model is not strict, weights missing in a checkpoint would be kept from the previously loaded label
+    initial_state = {k: v.clone() for k, v in model.model.state_dict().items()}
+
     predictions_dirs = {}
     for label in labels:
-        # Prepare the model
-        model_config = {
-            "num_classes": 2,  # Number of classes in the dataset
-            "learning_rate": 0.0001,  # Learning rate for training
-            "pretrained": True,  # Whether to use a pretrained model or not
-            "use_cuda": cuda.is_available(),  # Set to True if you want to use GPU acceleration
-            "threshold": 0.5,
-            "metrics": ["iou"]  # Evaluation metrics to be used
-        }
-        model = HRNet(model_config)
-        model.prepare()
-
         logging.debug(label)
 
         # Prepare path to the model
@@ -427,7 +695,8 @@ def run_aitlas_segmentation(labels, images_dir, custom_model=None):
 
         logging.debug(model_path)
 
-        # Load appropriate ADAF model
+        # Load appropriate ADAF model (starting from the initial weights)
+        model.model.load_state_dict(initial_state)
         model.load_model(model_path)
         logging.debug("Model successfully loaded.")
 
@@ -435,14 +704,38 @@ def run_aitlas_segmentation(labels, images_dir, custom_model=None):
         preds_dir = make_predictions_on_patches_segmentation(
             model=model,
             label=label,
-            patches_folder=images_dir
+            patches_folder=images_dir,
+            batch_size=batch_size,
+            tiles=tiles
         )
 
         predictions_dirs[label] = preds_dir
+        # Stream of tiles is consumed, all tiles are in images_dir for the remaining labels
+        tiles = None
 
     return predictions_dirs
 
 
+def tile_stream(tile_queue):
+    """Yields paths of tiles from the queue until None is received. If an exception is put into the queue, it is raised
+    (used to stop inference when creating the tiles fails).
+
+    Parameters
+    ----------
+    tile_queue : queue.Queue
+        Queue into which paths of finished tiles are put.
+
+    Yields
+    ------
+    str
+        Path to tile.
+    """
+    for tile in iter(tile_queue.get, None):
+        if isinstance(tile, BaseException):
+            raise tile
+        yield tile
+
+
 def main_routine(inp):
     """Main processing routine of ADAF. It is started by pressing the RUN button on the widget.
 
@@ -475,8 +768,24 @@ def main_routine(inp):
     log_path = save_dir / "logfile.txt"
     logger = Logger(log_path, log_time=time_started)
 
+    # Select name of the label for custom model
+    if inp.ml_model_custom == "Custom model":
+        labels = ["custom"]
+    else:
+        labels = inp.labels
+
+    if inp.ml_type == "object detection":
+        run_inference = run_aitlas_object_detection
+    elif inp.ml_type == "segmentation":
+        run_inference = run_aitlas_segmentation
+    else:
+        raise Exception("Wrong ml_type: choose 'object detection' or 'segmentation'")
+
     # --- VISUALIZATIONS ---
     logger.log_vis_inputs(dem_path, inp.vis_exist_ok)
+    if not inp.vis_exist_ok:
+        # Inference runs alongside visualizations, so its inputs are logged before anything starts
+        logger.log_inference_inputs(inp.ml_type, labels, inp.ml_model_custom, inp.custom_model_pth)
     t1 = time.time()
 
     # Determine nr_processes from available CPUs (leave two free)
@@ -495,39 +804,69 @@ def main_routine(inp):
             save_dir=save_dir.as_posix(),
             nr_processes=my_cpus
         )
+        inference = None
     else:
+        # Run inference in a separate thread, each tile is passed to it as soon as its visualization is finished
+        tile_queue = queue.Queue()
+
+        def run_inference_timed():
+            # Inference time is measured in the thread (it overlaps with visualizations)
+            t_start = time.time()
+            predictions = run_inference(
+                labels,
+                save_dir / "slrm",  # SLRM tiles are saved here (see tiled_processing)
+                inp.custom_model_pth,
+                tiles=tile_stream(tile_queue)
+            )
+            return predictions, time.time() - t_start
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        inference = executor.submit(run_inference_timed)
+        executor.shutdown(wait=False)
+
         # Create visualisations
-        out_paths = run_visualisations(
-            dem_path,
-            tile_size_px,
-            save_dir=save_dir.as_posix(),
-            nr_processes=my_cpus
-        )
+        try:
+            out_paths = run_visualisations(
+                dem_path,
+                tile_size_px,
+                save_dir=save_dir.as_posix(),
+                nr_processes=my_cpus,
+                tile_callback=tile_queue.put
+            )
+        except BaseException:
+            # Stop inference and wait for the thread to finish before passing on the error
+            tile_queue.put(RuntimeError("Visualizations failed, inference stopped"))
+            wait([inference])
+            raise
+        # No more tiles
+        tile_queue.put(None)
 
     vis_path = out_paths["output_directory"]
     vrt_path = out_paths["vrt_path"]
 
     t1 = time.time() - t1
+    if inference is not None:
+        logger.log_section("visualizations results")
     logger.log_vis_results(vis_path, vrt_path, inp.save_vis, t1)
 
     # Make sure it is a Path object!
     vis_path = Path(vis_path)
 
     # --- INFERENCE ---
-    # Select name of the label for custom model
-    if inp.ml_model_custom == "Custom model":
-        labels = ["custom"]
-    else:
-        labels = inp.labels
-
-    logger.log_inference_inputs(inp.ml_type,  labels, inp.ml_model_custom, inp.custom_model_pth)
     # For logger
     save_raw = []
-    t2 = time.time()
-    if inp.ml_type == "object detection":
-        logging.debug("Running object detection")
-        predictions_dict = run_aitlas_object_detection(labels, vis_path, inp.custom_model_pth)
+    logging.debug(f"Running {inp.ml_type}")
+    if inference is None:
+        logger.log_inference_inputs(inp.ml_type,  labels, inp.ml_model_custom, inp.custom_model_pth)
+        t2 = time.time()
+        predictions_dict = run_inference(labels, vis_path, inp.custom_model_pth)
+    else:
+        logger.log_section("inference results")
+        # Inference already runs alongside visualizations, wait for it and count its time from the start
+        predictions_dict, t_inference = inference.result()
+        t2 = time.time() - t_inference
 
+    if inp.ml_type == "object detection":
         vector_path = object_detection_vectors(
             predictions_dict,
             keep_ml_paths=inp.save_ml_output,
@@ -545,10 +884,7 @@ def main_routine(inp):
         else:
             save_raw = [a for _, a in predictions_dict.items()]
 
-    elif inp.ml_type == "segmentation":
-        logging.debug("Running segmentation")
-        predictions_dict = run_aitlas_segmentation(labels, vis_path, inp.custom_model_pth)
-
+    else:
         vector_path = semantic_segmentation_vectors(
             predictions_dict,
             keep_ml_paths=inp.save_ml_output,
@@ -565,16 +901,14 @@ def main_routine(inp):
             # Create VRT file for predictions
             for label, p_dir in predictions_dict.items():
                 logging.debug("Creating vrt for", label)
-                tif_list = glob.glob((Path(p_dir) / f"*{label}*.tif").as_posix())
+                with os.scandir(p_dir) as entries:
+                    tif_list = [a.path for a in entries if a.name.endswith(".tif") and label in a.name]
                 vrt_name = save_dir / (Path(p_dir).stem + ".vrt")
                 build_vrt_from_list(tif_list, vrt_name)
                 save_raw.append(vrt_name)
         else:
             for _, p_dir in predictions_dict.items():
                 shutil.rmtree(p_dir)
-
-    else:
-        raise Exception("Wrong ml_type: choose 'object detection' or 'segmentation'")
     t2 = time.time() - t2
 
     # Log inference results (roundness not used for obj. detection)
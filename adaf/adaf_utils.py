@@ -3,23 +3,159 @@ ADAF - utility functions
 Created on 26 May 2023
 @author: Nejc Čož, ZRC SAZU, Novi trg 2, 1000 Ljubljana, Slovenia
 """
+import collections.abc
 import logging
 import multiprocessing as mp
 import os
 import warnings
+from contextlib import contextmanager
 from pathlib import Path
 from time import localtime, strftime
 
 import numpy as np
 import rasterio
+import torch
 from aitlas.transforms import ResizeV2
-from aitlas.transforms import Transpose
 from osgeo import gdal
 from rasterio.windows import from_bounds
 
 warnings.filterwarnings("ignore", category=UserWarning)
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+# All patches have the same size, let cuDNN select the fastest convolution algorithms
+torch.backends.cudnn.benchmark = True
+
+
+@contextmanager
+def inference_context(model):
+    """Context for running predictions. Disables autograd and on GPU runs the model in mixed precision (FP16).
+
+    Parameters
+    ----------
+    model
+        Selected AITLAS ML model.
+    """
+    with torch.inference_mode():
+        if model.device.type == "cuda":
+            with torch.autocast(device_type="cuda", dtype=torch.float16):
+                yield
+        else:
+            yield
+
+
+class PatchDataset(torch.utils.data.Dataset):
+    """Dataset of image patches (GeoTIFF) used for inference."""
+    def __init__(self, image_paths):
+        self.image_paths = image_paths
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        return read_patch(self.image_paths[idx])
+
+
+class PatchStream(torch.utils.data.IterableDataset):
+    """Image patches read in the order their paths arrive (e.g. as soon as visualization of the tile is finished)."""
+    def __init__(self, image_paths):
+        self.image_paths = image_paths
+
+    def __iter__(self):
+        return (read_patch(a) for a in self.image_paths)
+
+
+def read_patch(image_path):
+    """Reads image patch and prepares it for the model (single band image is repeated to 3 bands).
+
+    Parameters
+    ----------
+    image_path : str
+        Path to image patch (GeoTIFF).
+
+    Returns
+    -------
+    (torch.Tensor, dict)
+        Image tensor (bands, height, width) and dictionary with path and rasterio metadata of the patch.
+    """
+    with rasterio.open(image_path) as image_tiff:
+        image = image_tiff.read()
+        meta = image_tiff.meta
+
+    if image.shape[0] == 1:
+        image = np.repeat(image, 3, axis=0)
+
+    return torch.from_numpy(image.astype(np.float32)), {"path": image_path, "meta": meta}
+
+
+def collate_patches(batch):
+    """Stacks images of patches into a batch, metadata is kept as a list."""
+    images, metas = zip(*batch)
+
+    return torch.stack(images), list(metas)
+
+
+def patches_loader(patches_folder, batch_size=8, tiles=None, num_workers=2, pin_memory=False):
+    """Creates DataLoader over all image patches (TIF files) in the folder. Patches are read in worker processes.
+
+    Parameters
+    ----------
+    patches_folder : str or pathlib.Path()
+        Path to folder containing images for inference.
+    batch_size : int
+        Number of patches in one batch.
+    tiles : iterable
+        Optional - iterable of paths to patches, used instead of listing the folder. Patches are read as the paths
+        arrive (in the main process), so inference can run while the patches are still being created.
+    num_workers : int
+        Number of worker processes for reading patches (0 reads them in the main process).
+    pin_memory : bool
+        Use page-locked memory for batches, speeds up copying to the GPU.
+
+    Returns
+    -------
+    torch.utils.data.DataLoader
+        Yields (images, metas) batches.
+    """
+    if tiles is not None:
+        return torch.utils.data.DataLoader(
+            PatchStream(tiles),
+            batch_size=batch_size,
+            collate_fn=collate_patches,
+            pin_memory=pin_memory
+        )
+
+    image_paths = [os.path.join(patches_folder, a) for a in os.listdir(patches_folder) if a.endswith(".tif")]
+
+    return torch.utils.data.DataLoader(
+        PatchDataset(image_paths),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=collate_patches,
+        pin_memory=pin_memory
+    )
+
+
+def bounding_boxes_to_str(predicted, label, epsg, res, x_min, y_max):
+    """Converts predicted bounding boxes of one patch to text, one line per bounding box. Metadata of the patch is
+    added to every line (required to construct vector from txt)."""
+    boxes = predicted['boxes'].detach().float().cpu().numpy()
+    scores = predicted['scores'].detach().float().cpu().numpy()
+
+    predictions_single_patch_str = ""
+    for box, score in zip(boxes, scores):
+        predictions_single_patch_str += (
+            f'{round(box[0])} '
+            f'{round(box[1])} '
+            f'{round(box[2])} '
+            f'{round(box[3])} '
+            f'{label} '
+            f'{score:.4f} '
+            f'{epsg} {res} {x_min} {y_max}'
+            f'\n'
+        )
+
+    return predictions_single_patch_str
+
 
 def make_predictions_on_single_patch_store_preds_single_class(
         model,
@@ -41,29 +177,24 @@ def make_predictions_on_single_patch_store_preds_single_class(
     if image.shape[0] == 1:
         image = np.repeat(image, 3, axis=0)
     image = np.transpose(image, (1, 2, 0))
-    predictions_single_patch_str = ""
     predicted = model.detect_objects_v2(image, [None], transform)
 
-    for i in range(0, len(predicted['boxes'])):
-        box = predicted['boxes'][i].detach().numpy()
-        score = predicted['scores'][i].detach().numpy()
-        predictions_single_patch_str += (
-            f'{round(box[0])} '
-            f'{round(box[1])} '
-            f'{round(box[2])} '
-            f'{round(box[3])} '
-            f'{label} '
-            f'{score:.4f} '
-            f'{epsg} {res} {x_min} {y_max}'
-            f'\n'
-        )
+    predictions_single_patch_str = bounding_boxes_to_str(predicted, label, epsg, res, x_min, y_max)
     filepath = os.path.join(predictions_dir, f"{os.path.splitext(image_filename)[0]}_{label}_bounding_boxes.txt")
     file = open(filepath, "w")
     file.write(predictions_single_patch_str)
     file.close()
 
 
-def make_predictions_on_patches_object_detection(model, label, patches_folder, predictions_dir=None):
+def make_predictions_on_patches_object_detection(
+        model,
+        label,
+        patches_folder,
+        predictions_dir=None,
+        batch_size=8,
+        tiles=None,
+        num_workers=2
+):
     """Generates predictions on patches (the model performs binary object detection).
 
     Parameters
@@ -77,6 +208,13 @@ def make_predictions_on_patches_object_detection(model, label, patches_folder, p
     predictions_dir : str or pathlib.Path()
         Optional - user can specify a custom folder. Otherwise, a folder called "predictions_segmentation_{label}" is
         created.
+    batch_size : int
+        Number of patches passed through the model at once.
+    tiles : iterable
+        Optional - iterable of paths to patches, used instead of listing patches_folder (e.g. tiles that are still
+        being created).
+    num_workers : int
+        Number of worker processes for reading patches.
 
     Returns
     -------
@@ -92,23 +230,43 @@ def make_predictions_on_patches_object_detection(model, label, patches_folder, p
     predictions_dir.mkdir(parents=True, exist_ok=True)
 
     logging.debug("Generating predictions:")
-    for file in os.listdir(patches_folder):
-        if file.endswith(".tif"):
-            logging.debug(">>> ", file)
-            image_path = os.path.join(patches_folder, file)
-            image_filename = file
-            make_predictions_on_single_patch_store_preds_single_class(
-                model,
-                label,
-                image_path,
-                image_filename,
-                str(predictions_dir)
-            )
+    model.eval()
+    with inference_context(model):
+        loader = patches_loader(
+            patches_folder, batch_size, tiles, num_workers=num_workers, pin_memory=model.device.type == "cuda"
+        )
+        for images, metas in loader:
+            outputs = model(images.to(model.device, non_blocking=True))
+            # Write results of each patch in the batch
+            for predicted, meta in zip(model.get_predicted(outputs), metas):
+                logging.debug(">>> ", meta["path"])
+                # The following are required to construct vector from txt
+                tile_meta = meta["meta"]
+                predictions_single_patch_str = bounding_boxes_to_str(
+                    predicted,
+                    label,
+                    tile_meta["crs"].to_epsg(),
+                    tile_meta["transform"].a,
+                    tile_meta["transform"].c,
+                    tile_meta["transform"].f
+                )
+                image_filename = Path(meta["path"]).stem
+                filepath = predictions_dir / f"{image_filename}_{label}_bounding_boxes.txt"
+                with open(filepath, "w") as file:
+                    file.write(predictions_single_patch_str)
 
     return str(predictions_dir)
 
 
-def make_predictions_on_patches_segmentation(model, label, patches_folder, predictions_dir=None):
+def make_predictions_on_patches_segmentation(
+        model,
+        label,
+        patches_folder,
+        predictions_dir=None,
+        batch_size=8,
+        tiles=None,
+        num_workers=2
+):
     """Generates predictions on patches (the model performs binary semantic segmentation).
 
     Parameters
@@ -122,6 +280,13 @@ def make_predictions_on_patches_segmentation(model, label, patches_folder, predi
     predictions_dir : str or pathlib.Path()
         Optional - user can specify a custom folder. Otherwise, a folder called "predictions_segmentation_{label}" is
         created.
+    batch_size : int
+        Number of patches passed through the model at once.
+    tiles : iterable
+        Optional - iterable of paths to patches, used instead of listing patches_folder (e.g. tiles that are still
+        being created).
+    num_workers : int
+        Number of worker processes for reading patches.
 
     Returns
     -------
@@ -137,16 +302,27 @@ def make_predictions_on_patches_segmentation(model, label, patches_folder, predi
     predictions_dir.mkdir(parents=True, exist_ok=True)
 
     logging.debug("Generating predictions:")
-    for file in os.listdir(patches_folder):
-        logging.debug(">>> ", file)
-        if file.endswith(".tif"):
-            image_path = os.path.join(patches_folder, file)
-            model.predict_masks_tiff_probs_binary(
-                image_path=image_path,
-                label=label,
-                data_transforms=Transpose(),
-                predictions_dir=str(predictions_dir)
-            )
+    model.eval()
+    with inference_context(model):
+        loader = patches_loader(
+            patches_folder, batch_size, tiles, num_workers=num_workers, pin_memory=model.device.type == "cuda"
+        )
+        for images, metas in loader:
+            outputs = model(images.to(model.device, non_blocking=True))
+            # HRNet returns a dictionary with the output tensor
+            if isinstance(outputs, collections.abc.Mapping):
+                outputs = outputs["out"]
+            predicted_probs, _ = model.get_predicted(outputs)
+            # Keep probabilities of the positive class
+            predicted_probs = predicted_probs[:, 1].float().cpu().numpy()
+
+            # Save masks with probabilities of each patch in the batch
+            for probs, meta in zip(predicted_probs, metas):
+                logging.debug(">>> ", meta["path"])
+                image_filename = Path(meta["path"]).stem
+                filepath = predictions_dir / f"{image_filename}_{label}_segmentation_mask_probs.tif"
+                with rasterio.open(filepath, "w", **meta["meta"]) as dst:
+                    dst.write(probs[np.newaxis, ...])
 
     return str(predictions_dir)
 
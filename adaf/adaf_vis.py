@@ -28,7 +28,8 @@ def tiled_processing(
         input_raster_path,
         extents_list,
         nr_processes=7,
-        save_dir=None
+        save_dir=None,
+        tile_callback=None
 ):
     """Tiled multiprocessing for RVT for larger rasters.
 
@@ -42,6 +43,9 @@ def tiled_processing(
         Number of processes for multiprocessing.
     save_dir : str or pathlib.Path()
         Path to directory to which results are saved.
+    tile_callback : callable
+        Optional - called with the path of each finished (SLRM) tile as soon as it is saved, e.g. to start inference
+        on it while other tiles are still being processed.
 
     Returns
     -------
@@ -114,8 +118,20 @@ def tiled_processing(
 
     # multiprocessing
     skipped_tiles = []
-    with mp.Pool(nr_processes) as p:
-        realist = [p.apply_async(process_one_tile, r) for r in input_process_list]
+    if tile_callback:
+        # Caller runs other threads (e.g. inference) while tiles are processed, forking them is not safe
+        mp_context = mp.get_context("spawn")
+
+        def tile_finished(pool_out):
+            # Pass finished tile on immediately (runs in the result handler thread of the pool)
+            if pool_out[0] == 0:
+                tile_callback(pool_out[3]["slrm"])
+    else:
+        mp_context = mp.get_context()
+        tile_finished = None
+
+    with mp_context.Pool(nr_processes) as p:
+        realist = [p.apply_async(process_one_tile, r, callback=tile_finished) for r in input_process_list]
         for result in realist:
             pool_out = result.get()
             # Check if tile was all NaN's (remove it from REFGRID!)
@@ -180,7 +196,8 @@ def process_one_tile(
 
     Returns
     -------
-        0 if successful, 1 if error (all NaNs encountered)
+        0 if successful, 1 if error (all NaNs encountered), tile ID, message and dictionary with paths to saved
+        visualizations (None if skipped).
     """
     # We only have SLRM, but potentially other visualizations can be added
     buffer_dict = {
@@ -204,10 +221,11 @@ def process_one_tile(
     # Then check, if output slice (w/o buffer) is all NaNs, then skip this tile if yes
     if (dict_arrays["array"][buffer:-buffer, buffer:-buffer] == np.nan).all():
         # If all NaNs encountered, output the tile ID
-        return 1, tile_id, f"Skipping, all NaNs in: {tile_name}"
+        return 1, tile_id, f"Skipping, all NaNs in: {tile_name}", None
 
     # --- START VISUALIZATION WITH RVT ---
 
+    saved_paths = {}
     for vis_type in buffer_dict:
         # Obtain buffer for current visualization type
         arr_buff = buffer_dict[vis_type]
@@ -261,8 +279,9 @@ def process_one_tile(
                                nodata=0)  # was NaN, use 0 for SLRM in ADAF
             with rasterio.open(arr_save_path, "w", **out_profile) as dst:
                 dst.write(arr_out)
+            saved_paths[i] = arr_save_path
 
-    return 0, tile_id, f"Finished processing: {tile_name}"
+    return 0, tile_id, f"Finished processing: {tile_name}", saved_paths
 
 
 def get_tile_from_raster(raster_path, extents, buffer):